@@ -21,10 +21,10 @@ def calc_mean_std(feat, eps=1e-5):
     size = feat.size()
     assert len(size) == 4, 'The input feature should be 4D tensor.'
     b, c = size[:2]
-    feat_var = feat.view(b, c, -1).var(dim=2) + eps
-    feat_std = feat_var.sqrt().view(b, c, 1, 1)
-    feat_mean = feat.view(b, c, -1).mean(dim=2).view(b, c, 1, 1)
-    return feat_mean, feat_std
+    # flatten once and get both statistics from a single reduction
+    feat_var, feat_mean = torch.var_mean(feat.view(b, c, -1), dim=2)
+    feat_std = (feat_var + eps).sqrt_().view(b, c, 1, 1)
+    return feat_mean.view(b, c, 1, 1), feat_std
 
 
 def adaptive_instance_normalization(content_feat, style_feat):
@@ -37,11 +37,12 @@ def adaptive_instance_normalization(content_feat, style_feat):
         content_feat (Tensor): The reference feature.
         style_feat (Tensor): The degradate features.
     """
-    size = content_feat.size()
     style_mean, style_std = calc_mean_std(style_feat)
     content_mean, content_std = calc_mean_std(content_feat)
-    normalized_feat = (content_feat - content_mean.expand(size)) / content_std.expand(size)
-    return normalized_feat * style_std.expand(size) + style_mean.expand(size)
+    # fold the per-channel statistics into one scale / shift so that only a single
+    # full-size op touches the features, the (b, c, 1, 1) stats broadcast directly
+    scale = style_std / content_std
+    return torch.addcmul(style_mean - content_mean * scale, content_feat, scale)
 
 
 class PositionEmbeddingSine(nn.Module):
@@ -1,4 +1,5 @@
 import math
+from contextlib import nullcontext
 from functools import partial
 
 import numpy as np
@@ -12,6 +13,22 @@ from basicsr.archs.vqvae_arch import VQVAE
 from basicsr.utils import get_root_logger
 from basicsr.utils.registry import ARCH_REGISTRY
 
+try:
+    # single-kernel LayerNorm, falls back to F.layer_norm for CPU tensors
+    from apex.normalization import FusedLayerNorm as LayerNorm
+except ImportError:
+    LayerNorm = nn.LayerNorm
+
+try:
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+
+    def _fast_sdpa_kernel():
+        return sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+except ImportError:
+    def _fast_sdpa_kernel():
+        return torch.backends.cuda.sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False)
+
+
 def calc_mean_std(feat, eps=1e-5):
     """Calculate mean and std for adaptive_instance_normalization.
 
@@ -23,10 +40,10 @@ def calc_mean_std(feat, eps=1e-5):
     size = feat.size()
     assert len(size) == 4, 'The input feature should be 4D tensor.'
     b, c = size[:2]
-    feat_var = feat.view(b, c, -1).var(dim=2) + eps
-    feat_std = feat_var.sqrt().view(b, c, 1, 1)
-    feat_mean = feat.view(b, c, -1).mean(dim=2).view(b, c, 1, 1)
-    return feat_mean, feat_std
+    # single fused pass over the features instead of separate var / mean reductions
+    feat_var, feat_mean = torch.var_mean(feat.reshape(b, c, -1), dim=2, unbiased=False)
+    feat_std = (feat_var + eps).sqrt_().view(b, c, 1, 1)
+    return feat_mean.view(b, c, 1, 1), feat_std
 
 
 def adaptive_instance_normalization(content_feat, style_feat):
@@ -39,11 +56,10 @@ def adaptive_instance_normalization(content_feat, style_feat):
         content_feat (Tensor): The reference feature.
         style_feat (Tensor): The degradate features.
     """
-    size = content_feat.size()
     style_mean, style_std = calc_mean_std(style_feat)
-    content_mean, content_std = calc_mean_std(content_feat)
-    normalized_feat = (content_feat - content_mean.expand(size)) / content_std.expand(size)
-    return normalized_feat * style_std.expand(size) + style_mean.expand(size)
+    # instance_norm normalizes the content features in one Welford pass
+    normalized_feat = F.instance_norm(content_feat, eps=1e-5)
+    return torch.addcmul(style_mean, normalized_feat, style_std)
 
 
 class PositionEmbeddingSine(nn.Module):
@@ -62,10 +78,22 @@ class PositionEmbeddingSine(nn.Module):
         if scale is None:
             scale = 2 * math.pi
         self.scale = scale
+        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32)
+        dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
+        self.register_buffer('dim_t', dim_t, persistent=False)
+        # without a mask the embedding only depends on the spatial size, cache it per (H, W, device)
+        self._cache = {}
 
     def forward(self, x, mask=None):
         if mask is None:
-            mask = torch.zeros((x.size(0), x.size(2), x.size(3)), device=x.device, dtype=torch.bool)
+            key = (x.size(2), x.size(3), x.device)
+            if key not in self._cache:
+                mask = torch.zeros((1, x.size(2), x.size(3)), device=x.device, dtype=torch.bool)
+                self._cache[key] = self._embed(mask)
+            return self._cache[key].expand(x.size(0), -1, -1, -1)
+        return self._embed(mask)
+
+    def _embed(self, mask):
         not_mask = ~mask
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
@@ -74,11 +102,8 @@ class PositionEmbeddingSine(nn.Module):
             y_embed = y_embed / (y_embed[:, -1:, :] + eps) * self.scale
             x_embed = x_embed / (x_embed[:, :, -1:] + eps) * self.scale
 
-        dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=x.device)
-        dim_t = self.temperature ** (2 * (dim_t // 2) / self.num_pos_feats)
-
-        pos_x = x_embed[:, :, :, None] / dim_t
-        pos_y = y_embed[:, :, :, None] / dim_t
+        pos_x = x_embed[:, :, :, None] / self.dim_t
+        pos_y = y_embed[:, :, :, None] / self.dim_t
         pos_x = torch.stack(
             (pos_x[:, :, :, 0::2].sin(), pos_x[:, :, :, 1::2].cos()), dim=4
         ).flatten(3)
@@ -100,24 +125,100 @@ def _get_activation_fn(activation):
 
 
 class TransformerSALayer(nn.Module):
-    def __init__(self, embed_dim, nhead=8, dim_mlp=2048, dropout=0.0, activation="gelu"):
+    def __init__(self, embed_dim, nhead=8, dim_mlp=2048, dropout=0.0, activation="gelu", fused=False):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(embed_dim, nhead, dropout=dropout)
+        assert embed_dim % nhead == 0, 'embed_dim should be divisible by nhead.'
+        self.fused = fused
+        self.nhead = nhead
+        self.head_dim = embed_dim // nhead
+        self.attn_dropout = dropout
+        # self attention, q/k/v projections are stacked like nn.MultiheadAttention.in_proj_weight
+        self.qkv = nn.Linear(embed_dim, 3 * embed_dim)
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        # same initialization as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.qkv.weight)
+        nn.init.constant_(self.qkv.bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
         # Implementation of Feedforward model - MLP
         self.linear1 = nn.Linear(embed_dim, dim_mlp)
-        self.dropout = nn.Dropout(dropout)
+        self.dropout = nn.Dropout(dropout) if dropout > 1e-6 else nn.Identity()
         self.linear2 = nn.Linear(dim_mlp, embed_dim)
 
-        self.norm1 = nn.LayerNorm(embed_dim)
-        self.norm2 = nn.LayerNorm(embed_dim)
-        self.dropout1 = nn.Dropout(dropout)
-        self.dropout2 = nn.Dropout(dropout)
+        self.norm1 = LayerNorm(embed_dim)
+        self.norm2 = LayerNorm(embed_dim)
+        self.dropout1 = nn.Dropout(dropout) if dropout > 1e-6 else nn.Identity()
+        self.dropout2 = nn.Dropout(dropout) if dropout > 1e-6 else nn.Identity()
 
         self.activation = _get_activation_fn(activation)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the switch from nn.MultiheadAttention
+        for old_key, new_key in (('self_attn.in_proj_weight', 'qkv.weight'),
+                                 ('self_attn.in_proj_bias', 'qkv.bias'),
+                                 ('self_attn.out_proj.weight', 'out_proj.weight'),
+                                 ('self_attn.out_proj.bias', 'out_proj.bias')):
+            if prefix + old_key in state_dict:
+                state_dict[prefix + new_key] = state_dict.pop(prefix + old_key)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def with_pos_embed(self, tensor, pos: Optional[Tensor]):
         return tensor if pos is None else tensor + pos
 
+    @staticmethod
+    def _add_residual(tgt, tgt2):
+        # accumulate into the freshly computed branch output instead of allocating the sum,
+        # unless autocast produced it in a narrower dtype than the residual stream
+        return tgt2.add_(tgt) if tgt2.dtype == tgt.dtype else tgt + tgt2
+
+    def _merge_masks(self, attn_mask, key_padding_mask, B, L, dtype):
+        """Convert nn.MultiheadAttention style masks into one additive mask for SDPA."""
+        mask = None
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                attn_mask = torch.zeros_like(attn_mask, dtype=dtype).masked_fill_(attn_mask, float('-inf'))
+            mask = attn_mask.to(dtype)
+            if mask.dim() == 3:
+                mask = mask.view(B, self.nhead, L, L)
+        if key_padding_mask is not None:
+            if key_padding_mask.dtype == torch.bool:
+                key_padding_mask = torch.zeros_like(key_padding_mask, dtype=dtype).masked_fill_(
+                    key_padding_mask, float('-inf'))
+            key_padding_mask = key_padding_mask.to(dtype).view(B, 1, 1, L)
+            mask = key_padding_mask if mask is None else mask + key_padding_mask
+        return mask
+
+    def self_attn(self, value, pos: Optional[Tensor] = None,
+                  attn_mask: Optional[Tensor] = None,
+                  key_padding_mask: Optional[Tensor] = None):
+        # value: normalized input (L, B, C), pos is only added to the query / key inputs
+        L, B, C = value.shape
+        if self.fused:
+            # a single projection reads the normalized input once, W_qk (x + pos) = W_qk x + W_qk pos
+            # with the position term projected at its own, usually (L, 1, C), shape
+            q, k, v = self.qkv(value).chunk(3, dim=-1)
+            if pos is not None:
+                pos_q, pos_k = F.linear(pos, self.qkv.weight[:2 * C]).chunk(2, dim=-1)
+                q, k = q + pos_q, k + pos_k
+        else:
+            w_qk, w_v = self.qkv.weight.split([2 * C, C])
+            b_qk, b_v = self.qkv.bias.split([2 * C, C])
+            q, k = F.linear(self.with_pos_embed(value, pos), w_qk, b_qk).chunk(2, dim=-1)
+            v = F.linear(value, w_v, b_v)
+        # (L, B, C) -> (B, H, L, D)
+        q, k, v = [t.view(L, B, self.nhead, self.head_dim).permute(1, 2, 0, 3) for t in (q, k, v)]
+
+        attn_mask = self._merge_masks(attn_mask, key_padding_mask, B, L, q.dtype)
+        # without a mask, half precision CUDA inputs can always use the flash / memory-efficient
+        # kernels, so keep SDPA from silently falling back to the unfused math path
+        fast_path = (attn_mask is None and q.is_cuda and q.dtype in (torch.float16, torch.bfloat16)
+                     and self.head_dim % 8 == 0)
+        with _fast_sdpa_kernel() if fast_path else nullcontext():
+            out = F.scaled_dot_product_attention(
+                q, k, v, attn_mask=attn_mask, dropout_p=self.attn_dropout if self.training else 0.0)
+        # (B, H, L, D) -> (L, B, C)
+        out = out.permute(2, 0, 1, 3).reshape(L, B, C)
+        return self.out_proj(out)
+
     def forward(self, tgt,
                 tgt_mask: Optional[Tensor] = None,
                 tgt_key_padding_mask: Optional[Tensor] = None,
@@ -125,15 +226,14 @@ class TransformerSALayer(nn.Module):
         
         # self attention
         tgt2 = self.norm1(tgt)
-        q = k = self.with_pos_embed(tgt2, query_pos)
-        tgt2 = self.self_attn(q, k, value=tgt2, attn_mask=tgt_mask,
-                              key_padding_mask=tgt_key_padding_mask)[0]
-        tgt = tgt + self.dropout1(tgt2)
+        tgt2 = self.self_attn(tgt2, query_pos, attn_mask=tgt_mask,
+                              key_padding_mask=tgt_key_padding_mask)
+        tgt = self._add_residual(tgt, self.dropout1(tgt2))
 
         # ffn
         tgt2 = self.norm2(tgt)
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(tgt2))))
-        tgt = tgt + self.dropout2(tgt2)
+        tgt = self._add_residual(tgt, self.dropout2(tgt2))
         return tgt
 
 class Fuse_sft_block(nn.Module):
@@ -141,23 +241,31 @@ class Fuse_sft_block(nn.Module):
         super().__init__()
         self.encode_enc = ResBlock(2*in_ch, out_ch)
 
-        self.scale = nn.Sequential(
-                    nn.Conv2d(in_ch, out_ch, kernel_size=3, padding=1),
+        # scale and shift branches side by side, the grouped second conv keeps them independent
+        self.scale_shift = nn.Sequential(
+                    nn.Conv2d(in_ch, 2*out_ch, kernel_size=3, padding=1),
                     nn.LeakyReLU(0.2, True),
-                    nn.Conv2d(out_ch, out_ch, kernel_size=3, padding=1))
-
-        self.shift = nn.Sequential(
-                    nn.Conv2d(in_ch, out_ch, kernel_size=3, padding=1),
-                    nn.LeakyReLU(0.2, True),
-                    nn.Conv2d(out_ch, out_ch, kernel_size=3, padding=1))
+                    nn.Conv2d(2*out_ch, 2*out_ch, kernel_size=3, padding=1, groups=2))
+        # NHWC conv weights let cuDNN pick its tensor-core kernels, the layout survives .to(device)
+        self.to(memory_format=torch.channels_last)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with separate scale / shift branches
+        for name in ('0.weight', '0.bias', '2.weight', '2.bias'):
+            scale_key, shift_key = f'{prefix}scale.{name}', f'{prefix}shift.{name}'
+            if scale_key in state_dict and shift_key in state_dict:
+                state_dict[f'{prefix}scale_shift.{name}'] = torch.cat(
+                    [state_dict.pop(scale_key), state_dict.pop(shift_key)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, enc_feat, dec_feat, w=1):
+        # no-ops when the features already are channels_last
+        enc_feat = enc_feat.contiguous(memory_format=torch.channels_last)
+        dec_feat = dec_feat.contiguous(memory_format=torch.channels_last)
         enc_feat = self.encode_enc(torch.cat([enc_feat, dec_feat], dim=1))
-        scale = self.scale(enc_feat)
-        shift = self.shift(enc_feat)
-        residual = w * (dec_feat * scale + shift)
-        out = dec_feat + residual
-        return out
+        scale, shift = self.scale_shift(enc_feat).chunk(2, dim=1)
+        # dec_feat + w * (dec_feat * scale + shift)
+        return torch.addcmul(shift, dec_feat, scale).mul_(w).add_(dec_feat)
 
 
 class AdaLNBeforeHead(nn.Module):
@@ -168,15 +276,18 @@ class AdaLNBeforeHead(nn.Module):
         self.ada_lin = nn.Sequential(nn.SiLU(inplace=False), nn.Linear(D, 2 * C))
 
     def forward(self, x_BLC: torch.Tensor, cond_BD: torch.Tensor):
-        scale, shift = self.ada_lin(cond_BD).view(-1, 1, 2, self.C).unbind(2)
-        return self.ln_wo_grad(x_BLC).mul(scale.add(1)).add_(shift)
+        scale, shift = self.ada_lin(cond_BD).chunk(2, dim=-1)
+        scale, shift = scale.unsqueeze(1), shift.unsqueeze(1)
+        # apply the adaptive affine in one elementwise pass over the normalized features
+        return torch.addcmul(shift, self.ln_wo_grad(x_BLC), scale.add(1))
 
 
 # @ARCH_REGISTRY.register()
 class CodeFormer2(VQVAE):
     def __init__(self, dim_embd=640, n_head=8, n_layers=9,
                 codebook_size=4096, latent_size=32,
-                 connect_list=['32', '64', '128', '256'], vqvae_path=None):
+                 connect_list=['32', '64', '128', '256'], vqvae_path=None, compile_ft_layers=False,
+                 infer_dtype=torch.bfloat16, fused_qkv=False):
         super(CodeFormer2, self).__init__(
             vocab_size=codebook_size, z_channels=32, ch=160, test_mode=False,
             share_quant_resi=4, v_patch_nums=(1, 2, 3, 4, 5, 6, 8, 10, 13, 16)
@@ -196,50 +307,88 @@ class CodeFormer2(VQVAE):
         self.n_layers = n_layers
         self.dim_embd = dim_embd
         self.dim_mlp = dim_embd*2
+        # autocast dtype of the transformer and logits head in eval mode, None keeps fp32
+        self.infer_dtype = infer_dtype
 
-        self.position_emb = nn.Parameter(torch.zeros(680, self.dim_embd))
+        # one position per token over all scales, 680 for the default v_patch_nums
+        self.position_emb = nn.Parameter(torch.zeros(sum(ph * pw for ph, pw in self.patch_hws), self.dim_embd))
         # self.feat_emb = nn.Linear(latent_size * len(self.vae.v_patch_nums), self.dim_embd)
-        self.feat_emb = nn.ModuleList(
-            nn.Embedding(codebook_size, self.dim_embd)
-            for (ph, pw) in self.patch_hws
-        )
+        # one embedding table per scale, fused into a single nn.Embedding
+        self.feat_emb = nn.Embedding(len(self.patch_hws) * codebook_size, self.dim_embd)
+        emb_offsets = torch.cat([torch.full((ph * pw,), si * codebook_size, dtype=torch.long)
+                                 for si, (ph, pw) in enumerate(self.patch_hws)])
+        self.register_buffer('emb_offsets', emb_offsets, persistent=False)
 
         # transformer
-        self.ft_layers = nn.Sequential(*[TransformerSALayer(embed_dim=dim_embd, nhead=n_head, dim_mlp=self.dim_mlp, dropout=0.0) 
-                                    for _ in range(self.n_layers)])
+        self.ft_layers = nn.ModuleList([TransformerSALayer(embed_dim=dim_embd, nhead=n_head, dim_mlp=self.dim_mlp, dropout=0.0,
+                                                           fused=fused_qkv)
+                                        for _ in range(self.n_layers)])
 
         # logits_predict head
         self.idx_pred_layer = nn.Sequential(
-            nn.LayerNorm(dim_embd),
+            LayerNorm(dim_embd),
             nn.Linear(dim_embd, codebook_size, bias=False))
 
+        if compile_ft_layers:
+            # compile the whole layer loop as one graph so fusion can cross layer boundaries,
+            # compile_ft_layers may also name the torch.compile mode, e.g. 'default' for training
+            mode = compile_ft_layers if isinstance(compile_ft_layers, str) else 'reduce-overhead'
+            self._forward_ft_layers = torch.compile(self._forward_ft_layers, mode=mode, fullgraph=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with one nn.Embedding per scale
+        old_keys = [f'{prefix}feat_emb.{si}.weight' for si in range(len(self.patch_hws))]
+        if all(k in state_dict for k in old_keys):
+            state_dict[prefix + 'feat_emb.weight'] = torch.cat([state_dict.pop(k) for k in old_keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def quantize_idx_pred_layer(self, quantize=True):
+        """Quantize the Linear of the logits head to int8 with dynamic quantization.
+
+        Meant for CPU inference and must be called after the trained weights are loaded,
+        the quantized head has a different state_dict layout. The logits stay fp32.
+        """
+        if quantize:
+            self.idx_pred_layer = torch.ao.quantization.quantize_dynamic(
+                self.idx_pred_layer, {nn.Linear}, dtype=torch.qint8)
+        return self
+
     def _init_weights(self, module):
         if isinstance(module, (nn.Linear, nn.Embedding)):
             module.weight.data.normal_(mean=0.0, std=0.02)
             if isinstance(module, nn.Linear) and module.bias is not None:
                 module.bias.data.zero_()
-        elif isinstance(module, nn.LayerNorm):
+        elif isinstance(module, (nn.LayerNorm, LayerNorm)):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
 
-    def forward(self, x, w=0, detach_16=True, code_only=False, adain=False):
-        # ################### Encoder #####################
-        x = self.quant_conv(self.encoder(x))
-        lq_feat = x  # B 32 16 16
-        idx_list = self.quantize.f_to_idxBl_or_fhat(lq_feat, to_fhat=False)
-        pos_emb = self.position_emb.unsqueeze(1).repeat(1,x.shape[0],1)
-
-        idx_embed_all = []
-        for i, idx in enumerate(idx_list):
-            idx_embed_all.append(self.feat_emb[i](idx))
-        idx_embed = torch.cat(idx_embed_all, dim=1).permute(1, 0, 2)
-        # torch.Size([256, 2, 640])
-        query_emb = idx_embed
+    def _forward_ft_layers(self, query_emb, pos_emb):
         for layer in self.ft_layers:
             query_emb = layer(query_emb, query_pos=pos_emb)
+        return query_emb
 
-        # torch.Size([256, 2, 640])
-        logits = self.idx_pred_layer(query_emb)
+    def forward(self, x, w=0, detach_16=True, code_only=False, adain=False):
+        # ################### Encoder #####################
+        # the VQVAE encoder and quantizer are frozen in __init__, skip autograd bookkeeping for them
+        with torch.inference_mode():
+            x = self.quant_conv(self.encoder(x))
+            idx_BL = self.quantize.f_to_idxBl_packed(x)
+        lq_feat = x.clone()  # B 32 16 16, a normal tensor that is safe to use outside inference mode
+
+        # shift the indices of every scale into its own slice of the fused table,
+        # looking up the transposed (L, B) indices gives the embedding directly in (L, B, C)
+        idx_embed = self.feat_emb((idx_BL + self.emb_offsets[:idx_BL.size(1)]).t())
+        # (L, 1, C) for the tokens actually produced, broadcast over the batch in with_pos_embed
+        pos_emb = self.position_emb[:idx_embed.size(0)].unsqueeze(1)
+        # torch.Size([680, 2, 640])
+        use_autocast = self.infer_dtype is not None and not self.training
+        with torch.autocast(device_type=x.device.type, dtype=self.infer_dtype, enabled=use_autocast):
+            query_emb = self._forward_ft_layers(idx_embed, pos_emb)
+
+            # torch.Size([680, 2, 640])
+            logits = self.idx_pred_layer(query_emb)
+        logits = logits.float()
+        # (L, B, N) -> (B, L, N), a view without a copy
         logits = logits.permute(1,0,2)
 
         return logits, lq_feat
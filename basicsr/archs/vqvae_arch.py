@@ -430,14 +430,30 @@ class VectorQuantizer2(nn.Module):
     def f_to_idxBl_or_fhat(self, f_BChw: torch.Tensor, to_fhat: bool,
                            v_patch_nums: Optional[Sequence[Union[int, Tuple[int, int]]]] = None) -> List[
         Union[torch.Tensor, torch.LongTensor]]:  # z_BChw is the feature from inp_img_no_grad
+        B = f_BChw.shape[0]
+        patch_hws = [(pn, pn) for pn in (v_patch_nums or self.v_patch_nums)]
+        return [f_hat.clone() if to_fhat else idx_N.reshape(B, ph * pw)
+                for ph, pw, idx_N, f_hat in self._iter_idx_fhat(f_BChw, patch_hws)]
+
+    def f_to_idxBl_packed(self, f_BChw: torch.Tensor,
+                          v_patch_nums: Optional[Sequence[Union[int, Tuple[int, int]]]] = None) -> torch.LongTensor:
+        # same as f_to_idxBl_or_fhat(to_fhat=False), but all scales are written into one (B, L) tensor
+        B = f_BChw.shape[0]
+        patch_hws = [(pn, pn) for pn in (v_patch_nums or self.v_patch_nums)]
+        idx_BL = torch.empty(B, sum(ph * pw for ph, pw in patch_hws), dtype=torch.long, device=f_BChw.device)
+        cur = 0
+        for ph, pw, idx_N, _ in self._iter_idx_fhat(f_BChw, patch_hws):
+            idx_BL[:, cur:cur + ph * pw] = idx_N.view(B, ph * pw)
+            cur += ph * pw
+        return idx_BL[:, :cur]
+
+    def _iter_idx_fhat(self, f_BChw: torch.Tensor, patch_hws: List[Tuple[int, int]]):
+        # yields (ph, pw, idx_N, f_hat) for every scale, from small to large
         B, C, H, W = f_BChw.shape
         f_no_grad = f_BChw.detach()
         f_rest = f_no_grad.clone()
         f_hat = torch.zeros_like(f_rest)
 
-        f_hat_or_idx_Bl: List[torch.Tensor] = []
-
-        patch_hws = [(pn, pn) for pn in (v_patch_nums or self.v_patch_nums)]
         assert patch_hws[-1][0] == H and patch_hws[-1][1] == W, f'{patch_hws[-1]=} != ({H=}, {W=})'
 
         SN = len(patch_hws)
@@ -462,9 +478,7 @@ class VectorQuantizer2(nn.Module):
             h_BChw = self.quant_resi[si / (SN - 1)](h_BChw)
             f_hat.add_(h_BChw)
             f_rest.sub_(h_BChw)
-            f_hat_or_idx_Bl.append(f_hat.clone() if to_fhat else idx_N.reshape(B, ph * pw))
-
-        return f_hat_or_idx_Bl
+            yield ph, pw, idx_N, f_hat
 
     # ===================== idxBl_to_var_input: only used in VAR training, for getting teacher-forcing input =====================
     def idxBl_to_var_input(self, gt_ms_idx_Bl: List[torch.Tensor]) -> torch.Tensor:
@@ -94,8 +94,7 @@ class CodeFormerIdxModel2(SRModel):
             # _, _, quant_stats = self.hq_vqvae_fix.quantize(x)
             # min_encoding_indices = quant_stats['min_encoding_indices']
             # self.idx_gt = min_encoding_indices.view(self.b, -1)
-            idx_gt = self.hq_vqvae_fix.quantize.f_to_idxBl_or_fhat(x_hq, to_fhat=False)
-            self.idx_gt = torch.cat(idx_gt, dim=1)
+            self.idx_gt = self.hq_vqvae_fix.quantize.f_to_idxBl_packed(x_hq)
 
         # if self.hq_feat_loss:
         #     # quant_feats